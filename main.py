@@ -1,13 +1,413 @@
+import bisect
+import codecs
+import collections.abc
+import concurrent.futures
 import curses
+import dataclasses
+import functools
+import itertools
+import locale
+import mmap
+import os
+import re
+import shutil
 import sys
 import signal
+import tempfile
 
 
 def is_end_of_line(y, x, lines):
     return x >= len(lines[y])
 
 
-PAIR_CHARS = {('"', '"'), ("'", "'"), ("(", ")"), ("[", "]"), ("<", ">"), ("{", "}")}
+GAP_SIZE = 16  # Initial size of the gap in a GapLine, in characters
+UNIT = 4  # Bytes per character in a GapLine buffer (UTF-32)
+
+
+class GapLine:
+    """
+    A line of text stored in a gap buffer, so that typing and deleting at the
+    cursor only touch the gap instead of rebuilding the whole line.
+    Characters are stored as UTF-32 so that column x starts at byte x * UNIT.
+    """
+
+    __slots__ = ("buf", "gap_start", "gap_end", "version", "_text", "_mask")
+
+    def __init__(self, text=""):
+        self.buf = bytearray(_encode_units(text)) + bytearray(GAP_SIZE * UNIT)
+        self.gap_start = len(text)
+        self.gap_end = len(text) + GAP_SIZE
+        self.version = 0
+        self._text = text
+        self._mask = None
+
+    def __len__(self):
+        return len(self.buf) // UNIT - (self.gap_end - self.gap_start)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice) and self._text is None and index.step is None:
+            start, end, _ = index.indices(len(self))
+            return self.substr(start, end)
+        return self.to_str()[index]
+
+    def __str__(self):
+        return self.to_str()
+
+    def __repr__(self):
+        return f"GapLine({self.to_str()!r})"
+
+    def to_str(self):
+        """
+        Return the line as a str. The result is cached until the next edit.
+        """
+        if self._text is None:
+            buf = self.buf
+            self._text = _decode_units(
+                buf[: self.gap_start * UNIT] + buf[self.gap_end * UNIT :]
+            )
+        return self._text
+
+    def word_mask(self):
+        """
+        Return the word mask of the line (see word_mask). Cached until the next edit.
+        """
+        if self._mask is None:
+            self._mask = _build_word_mask(self.to_str())
+        return self._mask
+
+    def substr(self, start, end):
+        """
+        Return the text between columns start and end without building the
+        whole line.
+        """
+        if self._text is not None:
+            return self._text[start:end]
+        end = min(end, len(self))
+        if start >= end:
+            return ""
+        buf, gap = self.buf, self.gap_end - self.gap_start
+        if end <= self.gap_start:
+            return _decode_units(buf[start * UNIT : end * UNIT])
+        if start >= self.gap_start:
+            return _decode_units(buf[(start + gap) * UNIT : (end + gap) * UNIT])
+        return _decode_units(
+            buf[start * UNIT : self.gap_start * UNIT]
+            + buf[self.gap_end * UNIT : (end + gap) * UNIT]
+        )
+
+    def insert(self, x, text):
+        """
+        Insert text before column x.
+        """
+        if not text:
+            return
+        self._move_gap(x)
+        self._reserve(len(text))
+        start = self.gap_start * UNIT
+        data = _encode_units(text)
+        self.buf[start : start + len(data)] = data
+        self.gap_start += len(text)
+        self._changed()
+
+    def delete(self, x, n):
+        """
+        Delete up to n characters starting at column x.
+        """
+        n = min(n, len(self) - x)
+        if n <= 0:
+            return
+        self._move_gap(x)
+        self.gap_end += n
+        self._changed()
+
+    def _move_gap(self, x):
+        x = min(x, len(self))
+        buf, start, end = self.buf, self.gap_start, self.gap_end
+        if x < start:
+            # Shift the characters in [x, start) to just before the gap end
+            n = start - x
+            buf[(end - n) * UNIT : end * UNIT] = buf[x * UNIT : start * UNIT]
+        elif x > start:
+            # Shift the characters after the gap to just after the gap start
+            n = x - start
+            buf[start * UNIT : x * UNIT] = buf[end * UNIT : (end + n) * UNIT]
+        self.gap_start, self.gap_end = x, end + (x - start)
+
+    def _reserve(self, n):
+        gap = self.gap_end - self.gap_start
+        if gap < n:
+            # Grow geometrically so repeated inserts stay amortized O(1)
+            grow = max(n - gap, len(self) + GAP_SIZE)
+            at = self.gap_end * UNIT
+            self.buf[at:at] = bytearray(grow * UNIT)
+            self.gap_end += grow
+
+    def _changed(self):
+        self.version += 1
+        self._text = None
+        self._mask = None
+
+
+def _encode_units(text):
+    return text.encode("utf-32-le", "surrogatepass")
+
+
+def _decode_units(data):
+    return data.decode("utf-32-le", "surrogatepass")
+
+
+def _is_word_char(char):
+    return char.isalnum() or char == "_"
+
+
+# bytes.translate table marking word characters (alphanumerics and "_") with
+# 1 and everything else with 0, used for ASCII lines
+WORD_BYTE_TABLE = bytes(_is_word_char(chr(code)) for code in range(256))
+
+
+class WordCharTable(dict):
+    """
+    str.translate table with the same marks as WORD_BYTE_TABLE, used for lines
+    with non-ASCII text. Code points are classified on first use.
+    """
+
+    def __missing__(self, code):
+        value = self[code] = "\x01" if _is_word_char(chr(code)) else "\x00"
+        return value
+
+
+WORD_CHAR_TABLE = WordCharTable()
+
+
+def word_mask(line):
+    """
+    Return bytes as long as line with 1 at word characters and 0 elsewhere,
+    so word edges can be found with bytes.find/bytes.rfind instead of a Python loop.
+    """
+    if isinstance(line, GapLine):
+        return line.word_mask()
+    return _build_word_mask(line)
+
+
+def _build_word_mask(text):
+    if text.isascii():
+        return text.encode("ascii").translate(WORD_BYTE_TABLE)
+    return text.translate(WORD_CHAR_TABLE).encode("ascii")
+
+
+def line_version(line):
+    """
+    Return the edit version of line. Together with the line itself this keys
+    caches: a str never changes and a GapLine bumps its version on every edit.
+    """
+    if isinstance(line, GapLine):
+        return line.version
+    return 0
+
+
+def editable_line(lines, y):
+    """
+    Return lines[y] as a GapLine, converting it in place on its first edit.
+    """
+    line = lines[y]
+    if not isinstance(line, GapLine):
+        line = lines[y] = GapLine(line)
+    return line
+
+
+BLOCK_SIZE = 512  # Lines per block of a LineBlocks
+
+
+class LineBlocks(collections.abc.MutableSequence):
+    """
+    The lines of a file kept in blocks of about BLOCK_SIZE lines, so that
+    inserting or deleting a line only shifts the rest of its block instead of
+    every line after it. Supports the list operations the editor uses.
+    """
+
+    def __init__(self, lines=()):
+        lines = list(lines)
+        self.blocks = [
+            lines[i : i + BLOCK_SIZE] for i in range(0, len(lines), BLOCK_SIZE)
+        ] or [[]]
+        self._reindex()
+
+    @classmethod
+    def from_blocks(cls, blocks):
+        """
+        Build from a list of blocks, each a list of lines or a MappedLines.
+        """
+        lines = cls()
+        lines.blocks = blocks or [[]]
+        lines._reindex()
+        return lines
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.blocks)
+
+    def __repr__(self):
+        return f"LineBlocks({list(self)!r})"
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._len)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            lines = []
+            if start < stop:
+                for block, i, n in self._spans(start, stop):
+                    lines += block[i : i + n]
+            return lines
+        k, i = self._locate(index)
+        return self._block(k)[i]
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._len)
+            if step != 1:
+                raise ValueError("LineBlocks only supports contiguous slices")
+            value = list(value)
+            if len(value) == stop - start:
+                # Same number of lines: replace them without moving any
+                for i, line in enumerate(value, start):
+                    self[i] = line
+            else:
+                del self[start:stop]
+                self._insert_lines(start, value)
+            return
+        k, i = self._locate(index)
+        self._block(k)[i] = value
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._len)
+            if step != 1:
+                for i in sorted(range(start, stop, step), reverse=True):
+                    del self[i]
+                return
+            if start >= stop:
+                return
+            first = self._locate(start)[0]
+            spans = list(self._spans(start, stop))
+            for block, i, n in spans:
+                del block[i : i + n]
+            last = first + len(spans)
+            # Drop the blocks the deletion emptied
+            self.blocks[first:last] = filter(None, self.blocks[first:last])
+        else:
+            k, i = self._locate(index)
+            block = self._block(k)
+            del block[i]
+            if not block:
+                del self.blocks[k]
+        if not self.blocks:
+            self.blocks.append([])
+        self._reindex()
+
+    def snapshot(self):
+        """
+        Return a copy of the lines as str that later edits do not change.
+        Blocks that were never edited stay in the mapped file instead of
+        being decoded.
+        """
+        return LineBlocks.from_blocks(
+            [
+                block if isinstance(block, MappedLines) else list(map(str, block))
+                for block in self.blocks
+            ]
+        )
+
+    def insert(self, index, value):
+        # Clamp the index like list.insert does
+        if index < 0:
+            index = max(index + self._len, 0)
+        self._insert_lines(min(index, self._len), [value])
+
+    def _insert_lines(self, index, lines):
+        if not lines:
+            return
+        if index == self._len:
+            k = len(self.blocks) - 1
+            i = len(self.blocks[k])
+        else:
+            k, i = self._locate(index)
+        block = self._block(k)
+        block[i:i] = lines
+        if len(block) > 2 * BLOCK_SIZE:
+            self.blocks[k : k + 1] = [
+                block[j : j + BLOCK_SIZE] for j in range(0, len(block), BLOCK_SIZE)
+            ]
+        self._reindex()
+
+    def _block(self, k):
+        """
+        Return block k as a list, decoding it first if it is still mapped.
+        """
+        block = self.blocks[k]
+        if not isinstance(block, list):
+            block = self.blocks[k] = block.decode()
+        return block
+
+    def _reindex(self):
+        # Index one past the last line of each block, for bisecting
+        self._ends = list(itertools.accumulate(map(len, self.blocks)))
+        self._len = self._ends[-1]
+
+    def _locate(self, index):
+        """
+        Return (block number, index within the block) of line index.
+        """
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("line index out of range")
+        k = bisect.bisect_right(self._ends, index)
+        return k, index - (self._ends[k - 1] if k else 0)
+
+    def _spans(self, start, stop):
+        """
+        Yield (block, start within the block, count) covering lines [start, stop).
+        """
+        k, i = self._locate(start)
+        remaining = stop - start
+        while remaining > 0:
+            block = self._block(k)
+            n = min(remaining, len(block) - i)
+            yield block, i, n
+            remaining -= n
+            k += 1
+            i = 0
+
+
+class MappedLines:
+    """
+    A block of lines that is still only in a memory-mapped file: the bytes
+    [start, end) holding count lines. Decoded when first needed.
+    """
+
+    __slots__ = ("mapped", "start", "end", "count")
+
+    def __init__(self, mapped, start, end, count):
+        self.mapped = mapped
+        self.start = start
+        self.end = end
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.decode())
+
+    def decode(self):
+        return self.mapped[self.start : self.end].decode(ENCODING).splitlines()
+
+
+# Opening character of each pair mapped to its closing character
+OPENERS = {'"': '"', "'": "'", "(": ")", "[": "]", "<": ">", "{": "}"}
 
 
 def find_pair_boundaries(y, x, lines):
@@ -15,27 +415,34 @@ def find_pair_boundaries(y, x, lines):
     Find the boundaries of pairs like "", '', {}, [], and ().
     Returns ((start_y, start_x), (end_y, end_x)) if a pair is found, otherwise None.
     """
-    for start_char, end_char in PAIR_CHARS:
-        start_pos, end_pos = None, None
-
-        # Search backward for the start character
-        cur_x = x
-        while cur_x >= 0:
-            if cur_x < len(lines[y]) and lines[y][cur_x] == start_char:
-                start_pos = (y, cur_x)
-                break
-            cur_x -= 1
+    line = lines[y]
+    span = _pair_span(line, line_version(line), x)
+    if span is None:
+        return None
+    return (y, span[0]), (y, span[1])
+
+
+@functools.lru_cache(maxsize=256)
+def _pair_span(line, version, x):
+    # Memoized per (line, version, x) so cycling selection stages on an
+    # unchanged line does not rescan it
+    line = str(line)
+
+    # Search backward once for each start character and try the nearest first,
+    # so the innermost pair around the cursor wins
+    openers = sorted(
+        ((line.rfind(start_char, 0, x + 1), start_char) for start_char in OPENERS),
+        reverse=True,
+    )
+    for start_x, start_char in openers:
+        if start_x == -1:
+            break
 
         # Search forward for the end character
-        cur_x = x
-        while cur_x < len(lines[y]):
-            if lines[y][cur_x] == end_char:
-                end_pos = (y, cur_x + 1)  # Include the end character in the selection
-                break
-            cur_x += 1
-
-        if start_pos and end_pos:
-            return start_pos, end_pos
+        end_x = line.find(OPENERS[start_char], x)
+        if end_x != -1:
+            # Include the end character in the selection
+            return start_x, end_x + 1
 
     return None
 
@@ -83,18 +490,39 @@ def find_word_boundaries(y, x, lines, current_selection):
     if not lines or y >= len(lines) or x >= len(lines[y]):
         return (y, x), (y, x), False  # No word at the cursor
 
-    start_x, end_x = x, x
+    line = lines[y]
+    start_x, end_x = _word_span(line, line_version(line), x)
+
+    entire_word_selected = current_selection == ((y, start_x), (y, end_x))
+    return (y, start_x), (y, end_x), entire_word_selected
+
+
+@functools.lru_cache(maxsize=256)
+def _word_span(line, version, x):
+    # Memoized per (line, version, x), see _pair_span
+    mask = word_mask(line)
 
     # Find the start of the word
-    while start_x > 0 and lines[y][start_x - 1].isalnum():
-        start_x -= 1
+    start_x = mask.rfind(b"\x00", 0, x) + 1
 
     # Find the end of the word
-    while end_x < len(lines[y]) and lines[y][end_x].isalnum():
-        end_x += 1
+    end_x = mask.find(b"\x00", x)
+    if end_x == -1:
+        end_x = len(mask)
 
-    entire_word_selected = current_selection == ((y, start_x), (y, end_x))
-    return (y, start_x), (y, end_x), entire_word_selected
+    return start_x, end_x
+
+
+def order_selection(selection_start, selection_end):
+    """
+    Return the two (y, x) ends of a selection as (start, end) in document order.
+    """
+    if selection_start[0] < selection_end[0] or (
+        selection_start[0] == selection_end[0]
+        and selection_start[1] <= selection_end[1]
+    ):
+        return selection_start, selection_end
+    return selection_end, selection_start
 
 
 def modify_selected_text(lines, selection_start, selection_end, modify_function):
@@ -102,8 +530,7 @@ def modify_selected_text(lines, selection_start, selection_end, modify_function)
         return lines, (0, 0)  # Return default cursor position if no selection
 
     # Determine the start and end points correctly
-    start_y, start_x = min(selection_start, selection_end)
-    end_y, end_x = max(selection_start, selection_end)
+    (start_y, start_x), (end_y, end_x) = order_selection(selection_start, selection_end)
 
     # Extract the selected text
     selected_text = extract_selected_text((start_y, start_x), (end_y, end_x), lines)
@@ -113,24 +540,41 @@ def modify_selected_text(lines, selection_start, selection_end, modify_function)
     modified_lines = modified_text.split("\n")
 
     # Merge the modified text back into the lines
+    first_line = editable_line(lines, start_y)
     if start_y == end_y:
         # Modification within a single line
-        lines[start_y] = lines[start_y][:start_x] + modified_text + lines[end_y][end_x:]
+        first_line.delete(start_x, end_x - start_x)
+        first_line.insert(start_x, modified_text)
     else:
         # Modification spans multiple lines
-        lines[start_y] = lines[start_y][:start_x] + modified_lines[0]
+        first_line.delete(start_x, len(first_line) - start_x)
+        first_line.insert(start_x, modified_lines[0])
 
         # Handle multiple modified lines
         if len(modified_lines) > 1:
-            lines[end_y] = modified_lines[-1] + lines[end_y][end_x:]
-            lines[start_y + 1 : end_y] = modified_lines[1:-1]
+            last_line = editable_line(lines, end_y)
+            last_line.delete(0, end_x)
+            last_line.insert(0, modified_lines[-1])
+            interior = len(modified_lines) - 2
+            if interior == end_y - start_y - 1:
+                # Same number of interior lines: overwrite them without
+                # shifting the rest of the file
+                for offset in range(1, interior + 1):
+                    lines[start_y + offset] = modified_lines[offset]
+            elif not interior:
+                del lines[start_y + 1 : end_y]
+            else:
+                lines[start_y + 1 : end_y] = modified_lines[1:-1]
         else:
             # Concatenate parts of the start and end line if modified_text is empty
-            lines[start_y] = lines[start_y][:start_x] + lines[end_y][end_x:]
+            first_line.insert(len(first_line), lines[end_y][end_x:])
             del lines[start_y + 1 : end_y + 1]
 
-    # Remove any empty lines that may have been introduced
-    lines = [line for line in lines if line.strip() != ""]
+    # Drop the line if the deletion left it empty, whether the selection was
+    # within it or joined it to the end of another line
+    if modified_text == "" and not len(first_line):
+        if len(lines) > 1:
+            del lines[start_y]
 
     # Calculate the new cursor position
     new_y, new_x = start_y, start_x
@@ -144,43 +588,65 @@ def modify_selected_text(lines, selection_start, selection_end, modify_function)
     return lines, (new_y, new_x)
 
 
+WORD_RE = re.compile(r"\w+")
+
+
+def word_boundaries(line):
+    """
+    Return (starts, ends), the sorted start and end columns of the words in line.
+    """
+    return _word_boundaries(line, line_version(line))
+
+
+@functools.lru_cache(maxsize=256)
+def _word_boundaries(line, version):
+    # Memoized per (line, version): a line is scanned once per edit and word
+    # motion on it is then a bisect
+    starts, ends = [], []
+    for match in WORD_RE.finditer(str(line)):
+        starts.append(match.start())
+        ends.append(match.end())
+    return starts, ends
+
+
 def move_to_next_word(y, x, lines, backward=False):
     if backward:
         return move_to_previous_word(y, x, lines)
 
-    if y >= len(lines) - 1 and x >= len(lines[y]) - 1:
-        # If at the last word of the last line, move to the beginning of the next line
-        if y < len(lines) - 1:
-            y += 1
-            x = 0
+    last_y = len(lines) - 1
+    line = lines[y]
+    line_len = len(line)
+    if y >= last_y and x >= line_len - 1:
+        # At the last word of the last line there is nowhere left to go
         return y, x
 
-    # Check if we're currently in the middle of a word
-    in_word = x < len(lines[y]) and lines[y][x].isalnum()
-
-    # If we're not in a word, move to the start of the next word or next line
-    if not in_word:
-        while y < len(lines) and x < len(lines[y]):
-            if lines[y][x].isalnum():
-                break
-            x += 1
-            if x >= len(lines[y]):
+    if x < line_len:
+        # Move to the end of the word under the cursor or of the next word
+        ends = word_boundaries(line)[1]
+        i = bisect.bisect_right(ends, x)
+        if i < len(ends):
+            x = ends[i]
+        else:
+            # No word left on this line: move to the end of the first word on
+            # the following lines, stopping at an empty line
+            while True:
                 y += 1
                 x = 0
-                if y >= len(lines):
-                    return len(lines) - 1, len(lines[-1]) - 1
-
-    # Move to the end of the current or next word
-    while y < len(lines) and x < len(lines[y]):
-        if not lines[y][x].isalnum():
-            break
-        x += 1
+                if y > last_y:
+                    return last_y, len(lines[last_y]) - 1
+                line = lines[y]
+                if not len(line):
+                    break
+                ends = word_boundaries(line)[1]
+                if ends:
+                    x = ends[0]
+                    break
+            line_len = len(line)
 
     # If no more words on the same line, move to the beginning of the next line
-    if x >= len(lines[y]):
-        if y < len(lines) - 1:
-            y += 1
-            x = 0
+    if x >= line_len and y < last_y:
+        y += 1
+        x = 0
 
     return y, x
 
@@ -189,49 +655,35 @@ def move_to_previous_word(y, x, lines, backward=False):
     if backward:
         return move_to_next_word(y, x, lines)
 
-    if y == 0 and x == 0:
-        # If at the first word of the first line, do nothing
-        return y, x
-
-    # Move left from the current position
-    if x > 0:
-        x -= 1
-
-    # If we are at the beginning of a line, move up to the end of the previous line
-    if x == 0 and y > 0:
+    # Move to the beginning of the current or previous word, searching the text
+    # before the cursor and then the previous lines
+    while True:
+        starts, ends = word_boundaries(lines[y])
+        i = bisect.bisect_left(starts, x)
+        if i:
+            return y, starts[i - 1]
+        if y == 0:
+            # If there is no word before the cursor, go to the start of the file
+            return 0, 0
         y -= 1
-        x = len(lines[y]) - 1
-
-    # Move to the beginning of the current or previous word
-    while y >= 0 and x >= 0 and not lines[y][x].isalnum():
-        x -= 1
-        if x < 0 and y > 0:
-            y -= 1
-            x = len(lines[y]) - 1
-
-    while y >= 0 and x > 0 and lines[y][x - 1].isalnum():
-        x -= 1
-
-    return y, x
+        x = len(lines[y])
 
 
 def extract_selected_text(start, end, lines):
     if not start or not end:
         return ""
 
-    selected_text = ""
     start_y, start_x = start
     end_y, end_x = end
 
     if start_y == end_y:
-        selected_text = lines[start_y][start_x:end_x]
-    else:
-        selected_text += lines[start_y][start_x:] + "\n"
-        for line_num in range(start_y + 1, end_y):
-            selected_text += lines[line_num] + "\n"
-        selected_text += lines[end_y][:end_x]
+        return lines[start_y][start_x:end_x]
 
-    return selected_text
+    # Join once instead of growing a string line by line
+    parts = [lines[start_y][start_x:]]
+    parts.extend(map(str, lines[start_y + 1 : end_y]))
+    parts.append(lines[end_y][:end_x])
+    return "\n".join(parts)
 
 
 def insert_character_at_cursor(lines, y, x, char):
@@ -240,28 +692,650 @@ def insert_character_at_cursor(lines, y, x, char):
         y, x = 0, 0
 
     # Insert the character at the cursor location
-    lines[y] = lines[y][:x] + char + lines[y][x:]
+    editable_line(lines, y).insert(x, char)
     return lines
 
 
+IO_BUFFER_SIZE = 1 << 20  # Buffer size for reading and writing files
+MMAP_THRESHOLD = 4 << 20  # Files larger than this are read through mmap
+# Most buffers a single writev call accepts (16 is the POSIX minimum)
+IOV_MAX = max(os.sysconf("SC_IOV_MAX"), 16)
+# Files are read and written as bytes, in the encoding text-mode open() uses
+ENCODING = locale.getpreferredencoding(False)
+
+
 def load_file(file_path):
     try:
-        with open(file_path, "r") as file:
-            lines = file.read().splitlines()
-        if not lines:  # If the file is empty, add an empty line
-            lines.append("")
-        return lines
+        fd = os.open(file_path, os.O_RDONLY)
     except FileNotFoundError:
         # If the file does not exist, create it with an empty content
-        with open(file_path, "w") as file:
-            pass
-        return [""]  # Return a list with one empty line
+        os.close(os.open(file_path, os.O_WRONLY | os.O_CREAT, 0o666))
+        return LineBlocks([""])  # Return a document with one empty line
+
+    try:
+        size = os.fstat(fd).st_size
+        if size > MMAP_THRESHOLD:
+            lines = read_mapped_lines(fd)
+        else:
+            lines = LineBlocks(read_all(fd, size).decode(ENCODING).splitlines())
+    finally:
+        os.close(fd)
+    if not lines:  # If the file is empty, add an empty line
+        lines.append("")
+    return lines
+
+
+def read_all(fd, size):
+    """Read a file of the given size, usually with a single read call."""
+    data = os.read(fd, size)
+    if len(data) < size:
+        chunks = [data]
+        while chunk := os.read(fd, IO_BUFFER_SIZE):
+            chunks.append(chunk)
+        data = b"".join(chunks)
+    return data
+
+
+def read_mapped_lines(fd):
+    """
+    Read the lines of a large file through mmap. Blocks of lines are decoded
+    from the mapping when first used, so the file is never held in memory as
+    both bytes and str. Files that break lines on anything but "\n" are
+    decoded up front instead.
+    """
+    mapped = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    if not breaks_only_on_newline(mapped):
+        with mapped:
+            lines = []
+            for raw_line in iter(mapped.readline, b""):
+                lines.extend(raw_line.decode(ENCODING).splitlines())
+        return LineBlocks(lines)
+
+    # Split the mapping into blocks of BLOCK_SIZE lines. The regex finds each
+    # block's end in one C-level scan instead of a find() call per line. It
+    # only runs up to the last "\n", so it never has to backtrack over a
+    # final line without one.
+    blocks = []
+    end = 0
+    lines_end = mapped.rfind(b"\n") + 1
+    block_pattern = re.compile(rb"(?:[^\n]*\n){1,%d}" % BLOCK_SIZE)
+    while end < lines_end:
+        start, end = block_pattern.match(mapped, end, lines_end).span()
+        blocks.append(MappedLines(mapped, start, end, BLOCK_SIZE))
+    if blocks:
+        # Only the last block can be short
+        last = blocks[-1]
+        last.count = mapped[last.start : last.end].count(b"\n")
+    if end < len(mapped):
+        # Last line, without a trailing newline
+        blocks.append(MappedLines(mapped, end, len(mapped), 1))
+    return LineBlocks.from_blocks(blocks)
+
+
+# Line breaks other than "\n" that str.splitlines() also splits on
+CONTROL_LINE_BREAKS = b"\r\x0b\x0c\x1c\x1d\x1e"
+UNICODE_LINE_BREAKS = "\x85\u2028\u2029"
+
+
+def breaks_only_on_newline(mapped):
+    """
+    Return True if the mapped file is UTF-8 whose only line breaks are "\n",
+    so counting "\n" gives the lines splitlines() would. Raises
+    UnicodeDecodeError for a file that does not decode, as reading it up front
+    would have.
+    """
+    if codecs.lookup(ENCODING).name != "utf-8":
+        return False
+    decoder = codecs.getincrementaldecoder(ENCODING)()
+    for start in range(0, len(mapped), IO_BUFFER_SIZE):
+        chunk = mapped[start : start + IO_BUFFER_SIZE]
+        text = decoder.decode(chunk)
+        # Deleting the control breaks is a fast way to test for any of them
+        if len(chunk.translate(None, CONTROL_LINE_BREAKS)) != len(chunk):
+            return False
+        if any(line_break in text for line_break in UNICODE_LINE_BREAKS):
+            return False
+    decoder.decode(b"", final=True)
+    return True
+
+
+def write_buffers(fd, buffers):
+    """
+    Write the list of byte strings to fd with one writev call, retrying after
+    partial writes. The list must not hold more than IOV_MAX buffers.
+    """
+    while buffers:
+        written = os.writev(fd, buffers)
+        # Drop the buffers that were written in full and the written part of
+        # the first one that was not
+        done = 0
+        while done < len(buffers) and written >= len(buffers[done]):
+            written -= len(buffers[done])
+            done += 1
+        buffers = buffers[done:]
+        if written:
+            buffers[0] = memoryview(buffers[0])[written:]
 
 
 def save_file(file_path, lines):
-    with open(file_path, "w") as file:
-        trimmed_lines = [line.rstrip() for line in lines]
-        file.write("\n".join(trimmed_lines))
+    # Write to a temporary file next to the target and rename it over the
+    # target, so a crash while saving never leaves a truncated file behind
+    target_path = os.path.realpath(file_path)
+    directory, name = os.path.split(target_path)
+    fd, temp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory)
+    try:
+        try:
+            # Encode line by line and hand the encoded lines to writev in
+            # batches of about IO_BUFFER_SIZE bytes, so neither the whole file
+            # nor a batch is ever joined into one string
+            chunk = []
+            chunk_size = 0
+            separator = b""
+            for line in lines:
+                data = separator + str(line).rstrip().encode(ENCODING)
+                chunk.append(data)
+                chunk_size += len(data)
+                if chunk_size >= IO_BUFFER_SIZE or len(chunk) == IOV_MAX:
+                    write_buffers(fd, chunk)
+                    chunk = []
+                    chunk_size = 0
+                separator = b"\n"
+            write_buffers(fd, chunk)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        try:
+            # Keep the permissions of the file being replaced
+            shutil.copymode(target_path, temp_path)
+        except FileNotFoundError:
+            pass
+        os.replace(temp_path, target_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def draw_row(stdscr, row, content, width, selected_attr):
+    """
+    Draw one screen row. content is (line, span) or None for a blank row,
+    where span is the (start_x, end_x) of the highlighted part of the line,
+    drawn with selected_attr.
+    """
+    stdscr.move(row, 0)
+    stdscr.clrtoeol()
+    if content is None:
+        return
+
+    line, span = content
+    if span is None:
+        stdscr.addnstr(row, 0, line, width)
+        return
+
+    start_x, end_x = span
+    if start_x == 0 and end_x >= len(line):
+        # Fully selected line: one write, no slicing
+        stdscr.addnstr(row, 0, line, width, selected_attr)
+        return
+
+    # Write the line once and recolour the selected cells in place
+    stdscr.addnstr(row, 0, line, width)
+    end_x = min(end_x, width)
+    if start_x < end_x:
+        stdscr.chgat(row, start_x, end_x - start_x, selected_attr)
+
+
+def draw_screen(stdscr, lines, top_row, selection, drawn_rows, width, rows=None):
+    """
+    Redraw the rows of the visible window [top_row, top_row + len(drawn_rows))
+    whose line or selection changed since the last frame.
+    drawn_rows holds what is currently on each screen row and is updated in place.
+    rows limits the check to those screen rows; by default every row is checked.
+    """
+    # With no selection, use an empty line range so no line is highlighted
+    sel_start_y, sel_end_y = 0, -1
+    if selection is not None:
+        (sel_start_y, sel_start_x), (sel_end_y, sel_end_x) = selection
+
+    # Loop invariants, looked up once per frame rather than once per row
+    selected_attr = curses.color_pair(1)
+    line_count = len(lines)
+    if rows is None:
+        rows = range(len(drawn_rows))
+    for row in rows:
+        i = top_row + row
+        if i < line_count:
+            # Only the part that fits is drawn, so a GapLine being typed
+            # into decodes at most width characters instead of the whole line
+            line = lines[i][:width]
+            span = None
+            if sel_start_y <= i <= sel_end_y:
+                start_x = sel_start_x if i == sel_start_y else 0
+                end_x = sel_end_x if i == sel_end_y else len(line)
+                span = (start_x, end_x)
+            content = (line, span)
+        else:
+            content = None
+
+        if drawn_rows[row] != content:
+            draw_row(stdscr, row, content, width, selected_attr)
+            drawn_rows[row] = content
+
+
+def scroll_rows(stdscr, drawn_rows, shift):
+    """
+    Scroll the window contents by shift rows (positive scrolls the text up)
+    and shift drawn_rows to match, so only the rows scrolled into view need
+    to be drawn. The rows that scroll in are left blank.
+    """
+    rows = len(drawn_rows)
+    if abs(shift) >= rows:
+        stdscr.erase()
+        drawn_rows[:] = [None] * rows
+        return
+
+    stdscr.scroll(shift)
+    if shift > 0:
+        drawn_rows[:] = drawn_rows[shift:] + [None] * shift
+    else:
+        drawn_rows[:] = [None] * -shift + drawn_rows[:shift]
+
+
+def changed_rows(dirty, top_row, height, selection, drawn_selection):
+    """
+    Screen rows that may need redrawing when no lines moved: the rows showing
+    a line in dirty, and the rows covered by the selection before and after it
+    changed.
+    """
+    rows = {i - top_row for i in dirty if top_row <= i < top_row + height}
+    if selection != drawn_selection:
+        for span in (selection, drawn_selection):
+            if span is not None:
+                (first, _), (last, _) = span
+                rows.update(
+                    range(max(first - top_row, 0), min(last - top_row + 1, height))
+                )
+    return rows
+
+
+@dataclasses.dataclass
+class EditorState:
+    """
+    Everything the key handlers read and modify.
+    """
+
+    file_path: str
+    lines: list
+    y: int = 0
+    x: int = 0
+    selection_start: tuple = None
+    selection_end: tuple = None
+    is_selecting: bool = False
+    extend_selection_forward: bool = True  # Extend the selection forward or backward
+    is_navigation_command: bool = False
+    selection_stage: int = 0
+    cur_line: object = ""  # lines[y], rebound whenever y moves
+    cur_len: int = 0  # len(lines[y]), kept up to date by every edit
+    needs_clamp: bool = False  # Set when an edit may leave the cursor out of range
+    saver: object = None  # Executor that writes saves in the background
+    pending_save: object = None  # Future of the most recent save, checked at exit
+    # Lines edited in place since the last frame, and whether lines were
+    # inserted or removed (which moves every row below them)
+    dirty: set = dataclasses.field(default_factory=set)
+    lines_moved: bool = True
+
+    def __post_init__(self):
+        self.cache_cur_line()
+
+    def cache_cur_line(self):
+        self.cur_line = self.lines[self.y]
+        self.cur_len = len(self.cur_line)
+
+    def clamp_cursor(self):
+        self.y = min(self.y, len(self.lines) - 1)
+        self.cache_cur_line()
+        self.x = min(self.x, self.cur_len)
+        self.needs_clamp = False
+
+
+def _handle_right(state):  # Right or Ctrl-f
+    if state.extend_selection_forward:
+        state.x = min(state.x + 1, state.cur_len)
+    else:
+        state.x = max(state.x - 1, 0)
+    if state.is_selecting:
+        state.selection_end = (state.y, state.x)
+    state.is_navigation_command = True
+
+
+def _handle_left(state):  # Left or Ctrl-b
+    if state.extend_selection_forward:
+        state.x = max(state.x - 1, 0)
+    else:
+        state.x = min(state.x + 1, state.cur_len)
+    if state.is_selecting:
+        state.selection_end = (state.y, state.x)
+    state.is_navigation_command = True
+
+
+def _handle_down(state):  # Down or Ctrl-n
+    lines = state.lines
+    if state.y >= len(lines) - 1:
+        # If on the last line, add a new empty line
+        lines.append("")
+        state.lines_moved = True
+    state.y = min(state.y + 1, len(lines) - 1)
+    state.cache_cur_line()
+    state.x = min(state.x, state.cur_len)
+    if state.is_selecting:
+        state.selection_end = (state.y, state.x)
+    state.is_navigation_command = True
+
+
+def _handle_up(state):  # Up or Ctrl-p
+    if state.y == 0:
+        # If on the first line, insert a new empty line at the beginning
+        state.lines.insert(0, "")
+        state.lines_moved = True
+        # No need to change y, as we want the cursor to move to the new line above
+    else:
+        state.y = max(state.y - 1, 0)
+    state.cache_cur_line()
+    state.x = min(state.x, state.cur_len)
+    if state.is_selecting:
+        state.selection_end = (state.y, state.x)
+    state.is_navigation_command = True
+
+
+def _handle_line_start(state):  # Ctrl-a
+    state.x = 0
+    if state.is_selecting:
+        state.selection_end = (state.y, state.x)
+    state.is_navigation_command = True
+
+
+def _handle_line_end(state):  # Ctrl-e
+    state.x = state.cur_len
+    if state.is_selecting:
+        state.selection_end = (state.y, state.x)
+    state.is_navigation_command = True
+
+
+def _handle_mark(state):  # Ctrl-Space
+    if not state.is_selecting:
+        state.selection_start = (state.y, state.x)
+        state.selection_end = (state.y, state.x)
+        state.is_selecting = True
+    else:
+        state.is_selecting = False
+
+
+def _handle_space(state):  # Space
+    if not state.is_selecting:
+        insert_character_at_cursor(state.lines, state.y, state.x, " ")  # Insert space
+        state.cur_line = state.lines[state.y]
+        state.dirty.add(state.y)
+        state.cur_len += 1
+        state.x += 1  # Move cursor right
+        state.is_navigation_command = True
+    elif state.is_navigation_command:
+        state.extend_selection_forward = not state.extend_selection_forward
+    else:
+        state.selection_start = None
+        state.selection_end = None
+        state.is_selecting = False
+    state.is_navigation_command = False
+
+
+def _handle_enter(state):  # Enter
+    # Split the current line at the cursor position
+    lines, y, x = state.lines, state.y, state.x
+    line = state.cur_line
+    # Move the rest of the line to the next line
+    lines.insert(y + 1, line[x:])
+    # Keep only the part of the line before the cursor
+    if isinstance(line, GapLine):
+        line.delete(x, len(line) - x)  # Cut in place, no new line is built
+    else:
+        lines[y] = line[:x]
+    state.y = min(y + 1, len(lines) - 1)
+    state.x = 0  # Reset cursor position to the start of the line
+    state.cache_cur_line()
+    state.lines_moved = True
+
+
+def _handle_tab(state):  # Tab
+    tab_spaces = "    "  # Represent a tab as 4 spaces (or use "\t" for a tab character)
+    state.cur_line = editable_line(state.lines, state.y)
+    state.cur_line.insert(state.x, tab_spaces)
+    state.dirty.add(state.y)
+    state.cur_len += len(tab_spaces)
+    state.x += len(tab_spaces)
+
+
+def _handle_backspace(state):  # Delete or Backspace
+    lines, y, x = state.lines, state.y, state.x
+    if x == 0 and y > 0:  # If at the beginning of a line, merge with the previous line
+        lines[y - 1] = (
+            str(lines[y - 1]).rstrip() + str(state.cur_line).lstrip()
+        )  # Merge lines without extra spaces
+        del lines[y]  # Remove the current line
+        state.y = y - 1
+        state.cache_cur_line()
+        state.x = state.cur_len  # Position the cursor at the end of the merged line
+        state.lines_moved = True
+    elif x > 0:
+        # Remove the character before the cursor
+        state.cur_line = editable_line(lines, y)
+        state.cur_line.delete(x - 1, 1)
+        state.dirty.add(y)
+        state.cur_len -= 1
+        state.x = x - 1  # Move cursor left
+
+
+def _insert_printable(state, char):  # Insert printable character
+    if not state.is_selecting:
+        insert_character_at_cursor(state.lines, state.y, state.x, char)
+        state.cur_line = state.lines[state.y]
+        state.dirty.add(state.y)
+        state.cur_len += 1
+        state.x += 1  # Move cursor right
+        state.is_navigation_command = True
+    else:
+        state.selection_start = None
+        state.selection_end = None
+        state.is_selecting = False
+    state.is_navigation_command = False
+
+
+def _handle_escape(state):  # Escape on its own
+    state.selection_start = None
+    state.selection_end = None
+    state.selection_stage = 0
+    state.is_selecting = False
+
+
+def _handle_alt_f(state):  # Alt-f
+    state.y, state.x = move_to_next_word(state.y, state.x, state.lines)
+    state.cache_cur_line()
+    if state.is_selecting:
+        state.selection_end = (state.y, state.x)
+
+
+def _handle_alt_b(state):  # Alt-b
+    state.y, state.x = move_to_previous_word(state.y, state.x, state.lines)
+    state.cache_cur_line()
+    if state.is_selecting:
+        state.selection_end = (state.y, state.x)
+
+
+def _handle_alt_n(state):  # Alt-n
+    state.selection_start, state.selection_end, state.selection_stage = alt_n_logic(
+        state.y, state.x, state.lines, state.selection_stage
+    )
+    state.is_selecting = True
+
+
+def _handle_alt_p(state):  # Alt-p
+    state.selection_start, state.selection_end, state.selection_stage = alt_p_logic(
+        state.y, state.x, state.lines, state.selection_stage
+    )
+    state.is_selecting = state.selection_stage != 0
+
+
+def _modify_selection(state, modify_function):
+    state.lines, (state.y, state.x) = modify_selected_text(
+        state.lines, state.selection_start, state.selection_end, modify_function
+    )
+    state.selection_start = None
+    state.selection_end = None
+    state.is_selecting = False
+    # The modify function may change the number and length of lines
+    state.needs_clamp = True
+    state.lines_moved = True
+
+
+def _handle_alt_m(state):  # Alt-m
+    _modify_selection(state, lambda text: text.upper())  # Example: Convert to uppercase
+
+
+def _handle_alt_u(state):  # Alt-u
+    _modify_selection(state, lambda text: "")  # Delete
+
+
+def _handle_alt_s(state):  # Alt-s
+    # Save a snapshot so further edits cannot race with the writer thread. A
+    # newer save supersedes the previous one, so only its outcome is kept.
+    snapshot = state.lines.snapshot()
+    state.pending_save = state.saver.submit(save_file, state.file_path, snapshot)
+
+
+def _handle_alt_space(state):  # Alt-Space
+    if state.selection_start and state.selection_end:
+        selected_text = extract_selected_text(
+            state.selection_start, state.selection_end, state.lines
+        )
+        # Handle the extracted text as needed
+
+
+# Keys that work both with and without an active selection
+KEY_HANDLERS = {
+    curses.KEY_RIGHT: _handle_right,
+    ord("\x06"): _handle_right,  # Ctrl-f
+    curses.KEY_LEFT: _handle_left,
+    ord("\x02"): _handle_left,  # Ctrl-b
+    curses.KEY_DOWN: _handle_down,
+    ord("\x0e"): _handle_down,  # Ctrl-n
+    curses.KEY_UP: _handle_up,
+    ord("\x10"): _handle_up,  # Ctrl-p
+    ord("\x01"): _handle_line_start,  # Ctrl-a
+    ord("\x05"): _handle_line_end,  # Ctrl-e
+    0: _handle_mark,  # Ctrl-Space
+}
+
+# Editing keys, ignored while a selection is active
+EDIT_HANDLERS = {
+    ord(" "): _handle_space,
+    curses.KEY_ENTER: _handle_enter,
+    ord("\n"): _handle_enter,
+    ord("\t"): _handle_tab,
+    curses.KEY_DC: _handle_backspace,
+    ord("\x7f"): _handle_backspace,
+}
+# Printable characters other than Space insert themselves. The character is
+# bound here once so typing does not call chr() per keystroke.
+EDIT_HANDLERS.update(
+    (key, functools.partial(_insert_printable, char=chr(key)))
+    for key in range(33, 127)
+)
+
+# How long to wait after Escape for the key of an Alt combination
+ESCAPE_TIMEOUT_MS = 50
+
+# Keys pressed after Escape/Alt
+ALT_HANDLERS = {
+    ord("f"): _handle_alt_f,
+    ord("b"): _handle_alt_b,
+    ord("n"): _handle_alt_n,
+    ord("p"): _handle_alt_p,
+    ord("m"): _handle_alt_m,
+    ord("u"): _handle_alt_u,
+    ord("s"): _handle_alt_s,
+    ord(" "): _handle_alt_space,
+}
+
+
+def read_keys(stdscr):
+    """
+    Wait for a key, then also take every key that is already waiting (such as
+    the rest of a paste) so they are all handled before the next redraw.
+    """
+    keys = [stdscr.getch()]
+    stdscr.nodelay(True)
+    try:
+        while (key := stdscr.getch()) != -1:
+            keys.append(key)
+    finally:
+        stdscr.nodelay(False)
+    return keys
+
+
+def read_alt_key(stdscr, keys):
+    """
+    Return the key after an Escape, or -1 if the Escape was pressed on its own.
+    Alt sends Escape and the key together. If the key did not arrive with the
+    batch, wait briefly so a bare Escape does not block until the next
+    keystroke.
+    """
+    key = next(keys, None)
+    if key is None:
+        stdscr.timeout(ESCAPE_TIMEOUT_MS)
+        key = stdscr.getch()
+        stdscr.timeout(-1)
+    return key
+
+
+def handle_keys(stdscr, state, keys):
+    """
+    Apply a batch of keys from read_keys to state. Return False if none of
+    them did anything, so the screen does not need to be redrawn.
+    """
+    changed = False
+    keys = iter(keys)
+    for key in keys:
+        if key == 27:  # Escape character for Alt key combinations
+            key = read_alt_key(stdscr, keys)
+            # Another Escape is not an Alt key: the first Escape was a bare
+            # one, and the next starts over
+            while key == 27:
+                _handle_escape(state)
+                changed = True
+                key = read_alt_key(stdscr, keys)
+            if key == -1:
+                _handle_escape(state)
+                changed = True
+                continue
+            handler = ALT_HANDLERS.get(key)
+            if handler is not None:
+                handler(state)
+                if state.needs_clamp:
+                    state.clamp_cursor()
+                changed = True
+            continue
+
+        # Handle other key presses
+        handler = KEY_HANDLERS.get(key)
+        if handler is not None:
+            handler(state)
+        elif state.is_selecting:
+            state.selection_end = (state.y, state.x)
+        else:
+            handler = EDIT_HANDLERS.get(key)
+            if handler is not None:
+                handler(state)
+            elif key != curses.KEY_RESIZE:
+                continue  # Unmapped key: nothing to do
+        changed = True
+    return changed
 
 
 def main(stdscr, file_path):
@@ -270,240 +1344,88 @@ def main(stdscr, file_path):
     stdscr.clear()
     curses.start_color()
     curses.init_pair(1, curses.COLOR_BLACK, curses.COLOR_WHITE)  # Selection color
+    # Let the window scroll so doupdate() can move rows with insert/delete-line
+    # sequences instead of rewriting them
+    stdscr.scrollok(True)
+    stdscr.idlok(True)
+    # Keypad mode holds a bare Escape for ESCDELAY (1 s by default) before
+    # getch() returns it; shorten that to the Alt key timeout
+    curses.set_escdelay(ESCAPE_TIMEOUT_MS)
 
     # Load the text from the file
-    lines = load_file(file_path)
-
-    y, x = 0, 0
-    alt_pressed = False
-    selection_start = None
-    selection_end = None
-    is_selecting = False
-    extend_selection_forward = True  # Flag to extend the selection forward or backward
-    is_navigation_command = False
-    selection_stage = 0  # Initialize the selection stage
-
-    while True:
-        try:
-            stdscr.clear()
-            # Display the text buffer with optional selection highlighting
-            for i, line in enumerate(lines):
-                if (
-                    is_selecting
-                    and selection_start is not None
-                    and selection_end is not None
-                ):
-                    # Determine the start and end of selection for highlighting
-                    sel_start_y, sel_start_x = min(selection_start, selection_end)
-                    sel_end_y, sel_end_x = max(selection_start, selection_end)
-
-                    if sel_start_y <= i <= sel_end_y:
-                        start_x = sel_start_x if i == sel_start_y else 0
-                        end_x = sel_end_x if i == sel_end_y else len(line)
-                        stdscr.addstr(i, 0, line[:start_x])
-                        stdscr.addstr(
-                            i, start_x, line[start_x:end_x], curses.color_pair(1)
-                        )
-                        stdscr.addstr(i, end_x, line[end_x:])
-                    else:
-                        stdscr.addstr(i, 0, line)
-                else:
-                    stdscr.addstr(i, 0, line)
-            stdscr.move(y, x)
-            key = stdscr.getch()
-            if key == 27:  # Escape character for Alt key combinations
-                alt_pressed = True
-                continue
+    state = EditorState(file_path, load_file(file_path))
 
-            # Handle Alt key press
-            if alt_pressed:
-                if key == ord("f"):  # Alt-f
-                    y, x = move_to_next_word(y, x, lines)
-                    if is_selecting:
-                        selection_end = (y, x)
-                elif key == ord("b"):  # Alt-b
-                    y, x = move_to_previous_word(y, x, lines)
-                    if is_selecting:
-                        selection_end = (y, x)
-                elif key == ord("n") and alt_pressed:  # Alt-n
-                    selection_start, selection_end, selection_stage = alt_n_logic(
-                        y, x, lines, selection_stage
-                    )
-                    is_selecting = True
-                elif key == ord("p") and alt_pressed:  # Alt-p
-                    selection_start, selection_end, selection_stage = alt_p_logic(
-                        y, x, lines, selection_stage
-                    )
-                    is_selecting = selection_stage != 0
-                elif key == ord("m") and alt_pressed:  # Alt-m
-                    modify_function = (
-                        lambda text: text.upper()
-                    )  # Example: Convert to uppercase
-                    lines, (y, x) = modify_selected_text(
-                        lines, selection_start, selection_end, modify_function
-                    )
-                    selection_start = None
-                    selection_end = None
-                    is_selecting = False
-                    # Validate cursor position
-                    y = min(y, len(lines) - 1)
-                    x = min(x, len(lines[y]) if lines else 0)
-                elif key == ord("u") and alt_pressed:  # Alt-u
-                    modify_function = lambda text: ""  # Delete
-                    lines, (y, x) = modify_selected_text(
-                        lines, selection_start, selection_end, modify_function
-                    )
-                    selection_start = None
-                    selection_end = None
-                    is_selecting = False
-                elif key == ord("s"):
-                    save_file(file_path, lines)
-                elif key == ord(" "):  # Alt-Space
-                    if selection_start and selection_end:
-                        selected_text = extract_selected_text(
-                            selection_start, selection_end, lines
-                        )
-                        # Handle the extracted text as needed
-                alt_pressed = False
-                continue
+    top_row = 0  # First line of the file shown on screen
+    drawn_top = 0  # top_row of the last drawn frame
+    screen_size = None
+    drawn_rows = []  # What is currently drawn on each screen row
+    drawn_selection = None  # Selection of the last drawn frame
 
-            # Handle other key presses
-            if key == curses.KEY_RIGHT or key == ord("\x06"):  # Ctrl-f
-                if extend_selection_forward:
-                    x = min(x + 1, len(lines[y]))
-                else:
-                    x = max(x - 1, 0)
-                if is_selecting:
-                    selection_end = (y, x)
-                is_navigation_command = True
-            elif key == curses.KEY_LEFT or key == ord("\x02"):  # Ctrl-b
-                if extend_selection_forward:
-                    x = max(x - 1, 0)
-                else:
-                    x = min(x + 1, len(lines[y]))
-                if is_selecting:
-                    selection_end = (y, x)
-                is_navigation_command = True
-            elif key == curses.KEY_DOWN or key == ord("\x0e"):  # Ctrl-n
-                if y >= len(lines) - 1:
-                    # If on the last line, add a new empty line
-                    lines.append("")
-                y = min(y + 1, len(lines) - 1)
-                x = min(x, len(lines[y]))
-                if is_selecting:
-                    selection_end = (y, x)
-                is_navigation_command = True
-            elif key == curses.KEY_UP or key == ord("\x10"):  # Ctrl-p
-                if y == 0:
-                    # If on the first line, insert a new empty line at the beginning
-                    lines.insert(0, "")
-                    # No need to change y, as we want the cursor to move to the new line above
-                else:
-                    y = max(y - 1, 0)
-                x = min(x, len(lines[y]))
-                if is_selecting:
-                    selection_end = (y, x)
-                is_navigation_command = True
-
-            elif key == ord("\x01"):  # Ctrl-a
-                x = 0
-                if is_selecting:
-                    selection_end = (y, x)
-                is_navigation_command = True
-            elif key == ord("\x05"):  # Ctrl-e
-                x = len(lines[y])
-                if is_selecting:
-                    selection_end = (y, x)
-                is_navigation_command = True
-            elif key == 0:  # Ctrl-Space
-                if not is_selecting:
-                    selection_start = (y, x)
-                    selection_end = (y, x)
-                    is_selecting = True
-                else:
-                    is_selecting = False
-            elif is_selecting:
-                selection_end = (y, x)
-            elif key == ord(" "):  # Space
-                if not is_selecting:
-                    lines = insert_character_at_cursor(lines, y, x, " ")  # Insert space
-                    x += 1  # Move cursor right
-                    is_navigation_command = True
-                elif is_navigation_command:
-                    extend_selection_forward = not extend_selection_forward
-                else:
-                    selection_start = None
-                    selection_end = None
-                    is_selecting = False
-                is_navigation_command = False
-            elif key == curses.KEY_ENTER or key == ord("\n"):  # Handle Enter key
-                # Split the current line at the cursor position
-                lines.insert(
-                    y + 1, lines[y][x:]
-                )  # Move the rest of the line to the next line
-                lines[y] = lines[y][
-                    :x
-                ]  # Keep only the part of the line before the cursor
-                y = min(y + 1, len(lines) - 1)
-                x = 0  # Reset cursor position to the start of the line
-
-            elif key == ord("\t"):  # Handle Tab key
-                tab_spaces = "    "  # Represent a tab as 4 spaces (or use "\t" for a tab character)
-                lines[y] = lines[y][:x] + tab_spaces + lines[y][x:]
-                x += len(tab_spaces)
-            elif key == curses.KEY_DC or key == ord("\x7f"):  # Delete or Backspace
-                if not lines:  # If lines list is empty, reset cursor
-                    y, x = 0, 0
-
-                if (
-                    x == 0 and y > 0
-                ):  # If at the beginning of a line, merge with the previous line
-                    lines[y - 1] = (
-                        lines[y - 1].rstrip() + lines[y].lstrip()
-                    )  # Merge lines without extra spaces
-                    del lines[y]  # Remove the current line
-                    y -= 1
-                    x = len(
-                        lines[y]
-                    )  # Position the cursor at the end of the merged line
-                elif x > 0:
-                    lines[y] = (
-                        lines[y][: x - 1] + lines[y][x:]
-                    )  # Remove the character before the cursor
-                    x -= 1  # Move cursor left
-
-                if not lines:  # If all lines are deleted
-                    lines.append("")  # Add an empty line
-                    y, x = 0, 0  # Reset cursor position
-
-                # Validate cursor position
-                y = min(y, len(lines) - 1)
-                x = min(x, len(lines[y]) if lines else 0)
-            elif key >= 32 and key <= 126:  # Insert printable character
-                if not is_selecting:
-                    char = chr(key)
-                    lines = insert_character_at_cursor(lines, y, x, char)
-                    x += 1  # Move cursor right
-                    # Validate cursor position
-                    y = min(y, len(lines) - 1)
-                    x = min(x, len(lines[y]) if lines else 0)
-                    is_navigation_command = True
-                else:
-                    selection_start = None
-                    selection_end = None
-                    is_selecting = False
-                is_navigation_command = False
-            elif is_selecting:
-                selection_end = (y, x)
-
-            # Validate cursor position
-            y = min(y, len(lines) - 1)
-            x = min(x, len(lines[y]) if lines else 0)
-
-            # Refresh the screen
-            stdscr.refresh()
-        except KeyboardInterrupt:
-            sys.exit(0)
+    # One worker, so saves reach the disk in the order they were requested
+    state.saver = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    try:
+        while True:
+            check_all = state.lines_moved
+            rows, cols = stdscr.getmaxyx()
+            if (rows, cols) != screen_size:
+                # First frame or terminal resized: repaint every row. erase()
+                # only blanks the window buffer; doupdate() then sends just the
+                # cells that differ instead of a clear-screen and full redraw
+                stdscr.erase()
+                screen_size = (rows, cols)
+                drawn_rows = [None] * rows
+                check_all = True
+
+            # Scroll so that the cursor line stays visible
+            y, x = state.y, state.x
+            if y < top_row:
+                top_row = y
+            elif y >= top_row + rows:
+                top_row = y - rows + 1
+
+            # Display the visible lines with optional selection highlighting
+            selection = None
+            selection_start = state.selection_start
+            selection_end = state.selection_end
+            if (
+                state.is_selecting
+                and selection_start is not None
+                and selection_end is not None
+            ):
+                selection = order_selection(selection_start, selection_end)
+            if top_row != drawn_top:
+                scroll_rows(stdscr, drawn_rows, top_row - drawn_top)
+                drawn_top = top_row
+                check_all = True
+            # Unless lines moved, only rows with edited lines or a changed
+            # selection can differ from what is on screen
+            check_rows = None
+            if not check_all:
+                check_rows = changed_rows(
+                    state.dirty, top_row, rows, selection, drawn_selection
+                )
+            draw_screen(
+                stdscr,
+                state.lines,
+                top_row,
+                selection,
+                drawn_rows,
+                cols - 1,
+                check_rows,
+            )
+            state.dirty.clear()
+            state.lines_moved = False
+            drawn_selection = selection
+            stdscr.move(y - top_row, min(x, cols - 1))
+            stdscr.noutrefresh()
+            curses.doupdate()
+            while not handle_keys(stdscr, state, read_keys(stdscr)):
+                pass  # Only unmapped keys: the screen is unchanged
+    finally:
+        # Let a save still in progress finish, and report if the latest one failed
+        state.saver.shutdown(wait=True)
+        if state.pending_save is not None:
+            state.pending_save.result()
 
 
 if __name__ == "__main__":